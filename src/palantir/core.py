@@ -8,18 +8,25 @@ import time
 import random
 import copy
 
-from sklearn.metrics import pairwise_distances
+from sklearn.metrics import pairwise_distances, pairwise_distances_argmin
 from sklearn import preprocessing
 from sklearn.neighbors import NearestNeighbors
-from joblib import Parallel, delayed
-from scipy.sparse.linalg import eigs
+from scipy.sparse.linalg import eigs, spsolve
 
-from scipy.sparse import csr_matrix, find, csgraph
-from scipy.stats import entropy, pearsonr, norm
-from numpy.linalg import inv
-from copy import deepcopy
+from scipy.sparse import csr_matrix, csgraph, eye
+from scipy.stats import norm
 from palantir.presults import PResults
 
+try:
+    from pynndescent import NNDescent
+except ImportError:
+    NNDescent = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
 import warnings
 warnings.filterwarnings(action="ignore", message="scipy.cluster")
 warnings.filterwarnings(action="ignore", module="scipy",
@@ -28,7 +35,8 @@ warnings.filterwarnings(action="ignore", module="scipy",
 
 def run_palantir(ms_data, early_cell, terminal_states=None,
                  knn=30, num_waypoints=1200, n_jobs=-1,
-                 scale_components=True, use_early_cell_as_start=False):
+                 scale_components=True, use_early_cell_as_start=False,
+                 nn_method='exact'):
     """Function for max min sampling of waypoints
 
     :param data: Multiscale space diffusion components
@@ -38,6 +46,8 @@ def run_palantir(ms_data, early_cell, terminal_states=None,
     :param num_waypoints: Number of waypoints to sample
     :param num_jobs: Number of jobs for parallel processing
     :param max_iterations: Maximum number of iterations for pseudotime convergence
+    :param nn_method: Nearest neighbor search for the cell graph, 'exact' or
+            'approximate'. 'approximate' requires pynndescent
     :return: PResults object with pseudotime, entropy, branch probabilities and waypoints
     """
 
@@ -50,9 +60,9 @@ def run_palantir(ms_data, early_cell, terminal_states=None,
     # ################################################
     # Determine the boundary cell closest to user defined early cell
     dm_boundaries = pd.Index(set(data.idxmax()).union(data.idxmin()))
-    dists = pairwise_distances(data.loc[dm_boundaries, :],
-                               data.loc[early_cell, :].values.reshape(1, -1))
-    start_cell = pd.Series(np.ravel(dists), index=dm_boundaries).idxmin()
+    start_cell = dm_boundaries[pairwise_distances_argmin(
+        data.loc[early_cell, :].values.reshape(1, -1),
+        data.values[data.index.get_indexer(dm_boundaries), :])[0]]
     if use_early_cell_as_start:
         start_cell = early_cell
 
@@ -78,7 +88,7 @@ def run_palantir(ms_data, early_cell, terminal_states=None,
     # pseudotime and weighting matrix
     print('Determining pseudotime...')
     pseudotime, W = _compute_pseudotime(data, start_cell, knn,
-                                        waypoints, n_jobs)
+                                        waypoints, n_jobs, nn_method)
 
     # Entropy and branch probabilities
     print('Entropy and branch probabilities...')
@@ -87,9 +97,11 @@ def run_palantir(ms_data, early_cell, terminal_states=None,
 
     # Project results to all cells
     print('Project results to all cells...')
-    branch_probs = pd.DataFrame(np.dot(
-        W.T, branch_probs.loc[W.index, :]), index=W.columns, columns=branch_probs.columns)
-    ent = branch_probs.apply(entropy, axis=1)
+    branch_probs = pd.DataFrame(
+        np.dot(W.values.T.astype(np.float32),
+               branch_probs.loc[W.index, :].values.astype(np.float32)),
+        index=W.columns, columns=branch_probs.columns)
+    ent = _branch_entropy(branch_probs)
 
     # UPdate results into PResults class object
     res = PResults(pseudotime, ent, branch_probs, waypoints)
@@ -112,29 +124,14 @@ def _max_min_sampling(data, num_waypoints):
 
     # Sample along each component
     N = data.shape[0]
-    for ind in data.columns:
-        # Data vector
-        vec = np.ravel(data[ind])
-
+    data_arr = np.asarray(data.values, dtype=np.float32)
+    for col in range(data.shape[1]):
         # Random initialzlation
-        iter_set = random.sample(range(N), 1)
-
-        # Distances along the component
-        dists = np.zeros([N, no_iterations])
-        dists[:, 0] = abs(vec - data[ind].values[iter_set])
-        for k in range(1, no_iterations):
-            # Minimum distances across the current set
-            min_dists = dists[:, 0:k].min(axis=1)
-
-            # Point with the maximum of the minimum distances is the new waypoint
-            new_wp = np.where(min_dists == min_dists.max())[0][0]
-            iter_set.append(new_wp)
-
-            # Update distances
-            dists[:, k] = abs(vec - data[ind].values[new_wp])
+        first_wp = random.sample(range(N), 1)[0]
 
         # Update global set
-        waypoint_set = waypoint_set + iter_set
+        waypoint_set = waypoint_set + \
+            list(_max_min_worker(data_arr[:, col], first_wp, no_iterations))
 
     # Unique waypoints
     waypoints = data.index[waypoint_set].unique()
@@ -142,8 +139,37 @@ def _max_min_sampling(data, num_waypoints):
     return waypoints
 
 
+def _max_min_worker(vec, first_wp, no_iterations):
+    """Farthest point sampling along a single component
+
+    :param vec: Values of the component for all cells
+    :param first_wp: Index of the randomly chosen first waypoint
+    :param no_iterations: Number of waypoints to sample
+    :return: Array of sampled waypoint indices
+    """
+    iter_set = np.empty(no_iterations, dtype=np.int64)
+    iter_set[0] = first_wp
+
+    # Running minimum of distances to the current set
+    min_dists = np.abs(vec - vec[first_wp])
+    for k in range(1, no_iterations):
+        # Point with the maximum of the minimum distances is the new waypoint
+        new_wp = min_dists.argmax()
+        iter_set[k] = new_wp
+
+        # Update the running minimum with distances to the new waypoint
+        min_dists = np.minimum(min_dists, np.abs(vec - vec[new_wp]))
+
+    return iter_set
+
+
+if njit is not None:
+    _max_min_worker = njit(cache=True)(_max_min_worker)
+
+
 def _compute_pseudotime(data, start_cell, knn,
-                        waypoints, n_jobs, max_iterations=25):
+                        waypoints, n_jobs, nn_method='exact',
+                        max_iterations=25):
     """Function for compute the pseudotime
 
     :param data: Multiscale space diffusion components
@@ -151,6 +177,8 @@ def _compute_pseudotime(data, start_cell, knn,
     :param knn: Number of nearest neighbors for graph construction
     :param waypoints: List of waypoints
     :param n_jobs: Number of jobs for parallel processing
+    :param nn_method: Nearest neighbor search for the cell graph, 'exact' or
+            'approximate'. 'approximate' requires pynndescent
     :param max_iterations: Maximum number of iterations for pseudotime convergence
     :return: pseudotime and weight matrix
     """
@@ -159,23 +187,32 @@ def _compute_pseudotime(data, start_cell, knn,
     # Shortest path distances to determine trajectories
     print('Shortest path distances using {}-nearest neighbor graph...'.format(knn))
     start = time.time()
-    nbrs = NearestNeighbors(n_neighbors=knn,
-                            metric='euclidean', n_jobs=n_jobs).fit(data)
-    adj = nbrs.kneighbors_graph(data, mode='distance')
+    N = data.shape[0]
+    if nn_method == 'approximate':
+        if NNDescent is None:
+            raise RuntimeError('Cannot use approximate nearest neighbors without installing pynndescent. \
+                \nPlease use "pip3 install pynndescent" to install pynndescent')
+        # Approximate nearest neighbors scale much better with the
+        # number of cells than the exact search
+        index = NNDescent(data.values, n_neighbors=knn, metric='euclidean',
+                          n_jobs=n_jobs, random_state=0)
+        ind, dist = index.neighbor_graph
+        adj = csr_matrix((np.ravel(dist),
+                          (np.repeat(np.arange(N), knn), np.ravel(ind))),
+                         shape=[N, N])
+    else:
+        nbrs = NearestNeighbors(n_neighbors=knn,
+                                metric='euclidean', n_jobs=n_jobs).fit(data)
+        adj = nbrs.kneighbors_graph(data, mode='distance')
 
     # Connect graph if it is disconnected
-    adj = _connect_graph(adj, data, np.where(data.index == start_cell)[0][0])
-
-    # Distances
-    dists = Parallel(n_jobs=n_jobs)(
-        delayed(_shortest_path_helper)(np.where(data.index == cell)[0][0], adj)
-        for cell in waypoints)
-
-    # Convert to distance matrix
-    D = pd.DataFrame(0.0, index=waypoints, columns=data.index)
-    for i, cell in enumerate(waypoints):
-        D.loc[cell, :] = pd.Series(np.ravel(dists[i]),
-                                   index=data.index[dists[i].index])[data.index]
+    adj = _connect_graph(adj, data, data.index.get_loc(start_cell))
+
+    # Distances from waypoints to all the cells
+    wp_idx = data.index.get_indexer(waypoints)
+    D = pd.DataFrame(csgraph.dijkstra(adj, directed=False, indices=wp_idx,
+                                      return_predecessors=False),
+                     index=waypoints, columns=data.index)
     end = time.time()
     print('Time for shortest paths: {} minutes'.format((end - start) / 60))
 
@@ -190,42 +227,74 @@ def _compute_pseudotime(data, start_cell, knn,
     W = W / W.sum()
 
     # Initalize pseudotime to start cell distances
-    pseudotime = D.loc[start_cell, :]
+    D_arr = np.ascontiguousarray(D.values, dtype=np.float32)
+    W_arr = np.ascontiguousarray(W.values, dtype=np.float32)
+    wp_cols = D.columns.get_indexer(waypoints)
+    traj = D_arr[0, :].copy()
     converged = False
 
     # Iteratively update perspective and determine pseudotime
     iteration = 1
     while not converged and iteration < max_iterations:
-        # Perspective matrix by alinging to start distances
-        P = deepcopy(D)
-        for wp in waypoints[1:]:
-            # Position of waypoints relative to start
-            idx_val = pseudotime[wp]
-
-            # Convert all cells before starting point to the negative
-            before_indices = pseudotime.index[pseudotime < idx_val]
-            P.loc[wp, before_indices] = -D.loc[wp, before_indices]
-
-            # Align to start
-            P.loc[wp, :] = P.loc[wp, :] + idx_val
-
-        # Weighted pseudotime
-        new_traj = P.multiply(W).sum()
+        # Perspective matrix by alinging to start distances and
+        # weighted pseudotime
+        new_traj = _perspective_update(D_arr, W_arr, traj, wp_cols)
 
         # Check for convergence
-        corr = pearsonr(pseudotime, new_traj)[0]
+        corr = np.corrcoef(traj, new_traj)[0, 1]
         print('Correlation at iteration %d: %.4f' % (iteration, corr))
         if corr > 0.9999:
             converged = True
 
         # If not converged, continue iteration
-        pseudotime = new_traj
+        traj = new_traj
         iteration += 1
 
+    pseudotime = pd.Series(traj, index=D.columns)
     return pseudotime, W
 
 
-def identify_terminal_states(ms_data, early_cell, knn=30, num_waypoints=1200, n_jobs=-1):
+def _perspective_update(D_arr, W_arr, traj, wp_cols):
+    """One perspective-weighted pseudotime update
+
+    :param D_arr: Waypoint to cell distances [Waypoints X Cells]
+    :param W_arr: Waypoint weights [Waypoints X Cells]
+    :param traj: Current pseudotime of all cells
+    :param wp_cols: Column positions of the waypoints
+    :return: Updated pseudotime of all cells
+    """
+    # Convert all cells before each waypoint to the negative and
+    # align to start; the start cell stays at its distances
+    traj_at_wp = traj[wp_cols][:, np.newaxis]
+    P = np.where(traj[np.newaxis, :] < traj_at_wp,
+                 -D_arr, D_arr) + traj_at_wp
+    P[0, :] = D_arr[0, :]
+
+    # Weighted pseudotime
+    return (P * W_arr).sum(axis=0)
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _perspective_update(D_arr, W_arr, traj, wp_cols):
+        # Parallel version of the update above, reducing over waypoints
+        # per cell without materializing the perspective matrix
+        n_wp, n_cells = D_arr.shape
+        new_traj = np.empty(n_cells, dtype=D_arr.dtype)
+        for j in prange(n_cells):
+            acc = D_arr[0, j] * W_arr[0, j]
+            for i in range(1, n_wp):
+                t_wp = traj[wp_cols[i]]
+                d = D_arr[i, j]
+                if traj[j] < t_wp:
+                    d = -d
+                acc += (d + t_wp) * W_arr[i, j]
+            new_traj[j] = acc
+        return new_traj
+
+
+def identify_terminal_states(ms_data, early_cell, knn=30, num_waypoints=1200,
+                             n_jobs=-1, nn_method='exact'):
 
     # Scale components
     data = pd.DataFrame(preprocessing.minmax_scale(ms_data),
@@ -233,9 +302,9 @@ def identify_terminal_states(ms_data, early_cell, knn=30, num_waypoints=1200, n_
 
     #  Start cell as the nearest diffusion map boundary
     dm_boundaries = pd.Index(set(data.idxmax()).union(data.idxmin()))
-    dists = pairwise_distances(data.loc[dm_boundaries, :],
-                               data.loc[early_cell, :].values.reshape(1, -1))
-    start_cell = pd.Series(np.ravel(dists), index=dm_boundaries).idxmin()
+    start_cell = dm_boundaries[pairwise_distances_argmin(
+        data.loc[early_cell, :].values.reshape(1, -1),
+        data.values[data.index.get_indexer(dm_boundaries), :])[0]]
 
     # Sample waypoints
     # Append start cell
@@ -248,7 +317,7 @@ def identify_terminal_states(ms_data, early_cell, knn=30, num_waypoints=1200, n_
 
     # Distance to start cell as pseudo pseudotime
     pseudotime, _ = _compute_pseudotime(data, start_cell, knn,
-                                        waypoints, n_jobs)
+                                        waypoints, n_jobs, nn_method)
 
     # Markov chain
     wp_data = data.loc[waypoints, :]
@@ -265,18 +334,32 @@ def identify_terminal_states(ms_data, early_cell, knn=30, num_waypoints=1200, n_
     return terminal_states, excluded_boundaries
 
 
+# Cache of the last waypoint neighbor search, keyed by data content and k
+_knn_cache = {}
+
+
 def _construct_markov_chain(wp_data, knn, pseudotime, n_jobs):
 
     # Markov chain construction
     print('Markov chain construction...')
     waypoints = wp_data.index
 
-    # kNN graph
+    # kNN graph, reusing the previous search if the waypoint data and k
+    # are unchanged
     n_neighbors = knn
-    nbrs = NearestNeighbors(n_neighbors=n_neighbors, metric='euclidean',
-                            n_jobs=n_jobs).fit(wp_data)
-    kNN = nbrs.kneighbors_graph(wp_data, mode='distance')
-    dist, ind = nbrs.kneighbors(wp_data)
+    key = (wp_data.shape, n_neighbors, hash(wp_data.values.tobytes()))
+    if key in _knn_cache:
+        dist, ind = _knn_cache[key]
+    else:
+        nbrs = NearestNeighbors(n_neighbors=n_neighbors, metric='euclidean',
+                                n_jobs=n_jobs).fit(wp_data)
+        dist, ind = nbrs.kneighbors(wp_data)
+        _knn_cache.clear()
+        _knn_cache[key] = (dist, ind)
+    kNN = csr_matrix((np.ravel(dist),
+                      (np.repeat(np.arange(len(waypoints)), n_neighbors),
+                       np.ravel(ind))),
+                     [len(waypoints), len(waypoints)])
 
     # Standard deviation allowing for "back" edges
     adpative_k = np.min([int(np.floor(n_neighbors / 3)) - 1, 30])
@@ -284,32 +367,28 @@ def _construct_markov_chain(wp_data, knn, pseudotime, n_jobs):
 
     # Directed graph construction
     # pseudotime position of all the neighbors
-    traj_nbrs = pd.DataFrame(pseudotime[np.ravel(waypoints[ind])].values.reshape(
-        [len(waypoints), n_neighbors]), index=waypoints)
+    traj_arr = pseudotime[waypoints].values
+    traj_nbrs = traj_arr[ind]
 
     # Remove edges that move backwards in pseudotime except for edges that are within
     # the computed standard deviation
-    rem_edges = traj_nbrs.apply(
-        lambda x: x < pseudotime[traj_nbrs.index] - adaptive_std)
-    rem_edges = rem_edges.stack()[rem_edges.stack()]
-
-    # Determine the indices and update adjacency matrix
-    cell_mapping = pd.Series(range(len(waypoints)), index=waypoints)
-    x = list(cell_mapping[rem_edges.index.get_level_values(0)])
-    y = list(rem_edges.index.get_level_values(1))
+    x, y = np.where(traj_nbrs < (traj_arr - adaptive_std)[:, np.newaxis])
     # Update adjacecy matrix
     kNN[x, ind[x, y]] = 0
 
-    # Affinity matrix and markov chain
-    x, y, z = find(kNN)
-    aff = np.exp(-(z ** 2) / (adaptive_std[x] ** 2) * 0.5 -
-                  (z ** 2) / (adaptive_std[y] ** 2) * 0.5)
-    W = csr_matrix((aff, (x, y)), [len(waypoints), len(waypoints)])
+    # Affinity matrix and markov chain, computed in place on the CSR data
+    kNN.eliminate_zeros()
+    W = kNN
+    x = np.repeat(np.arange(len(waypoints)), np.diff(W.indptr))
+    y = W.indices
+    np.exp(-0.5 * (W.data ** 2) *
+           (1 / adaptive_std[x] ** 2 + 1 / adaptive_std[y] ** 2),
+           out=W.data)
 
     # Transition matrix
     D = np.ravel(W.sum(axis=1))
-    x, y, z = find(W)
-    T = csr_matrix((z / D[x], (x, y)), [len(waypoints), len(waypoints)])
+    W.data /= D[x]
+    T = W
 
     return T
 
@@ -320,9 +399,12 @@ def _terminal_states_from_markov_chain(T, wp_data, pseudotime):
     # Identify terminal statses
     waypoints = wp_data.index
     dm_boundaries = pd.Index(set(wp_data.idxmax()).union(wp_data.idxmin()))
-    vals, vecs = eigs(T.T, 10)
+    # Shift-invert around the stationary eigenvalue: ARPACK factorizes
+    # (T' - sigma I) once with a sparse LU and converges in few iterations
+    vals, vecs = eigs(T.T.tocsc().astype(np.float64), k=1, sigma=1.001,
+                      which='LM', tol=1e-6, v0=np.ones(T.shape[0]))
 
-    ranks = np.abs(np.real(vecs[:, np.argsort(vals)[-1]]))
+    ranks = np.abs(np.real(vecs[:, 0]))
     ranks = pd.Series(ranks, index=waypoints)
 
     # Cutoff and intersection with the boundary cells
@@ -333,15 +415,15 @@ def _terminal_states_from_markov_chain(T, wp_data, pseudotime):
     cells = ranks.index[ranks > cutoff]
 
     # Find connected components
-    T_dense = pd.DataFrame(T.todense(), index=waypoints, columns=waypoints)
-    graph = nx.from_pandas_adjacency(T_dense.loc[cells, cells])
-    cells = [pseudotime[i].idxmax() for i in nx.connected_components(graph)]
-
-    # Nearest diffusion map boundaries
-    terminal_states = [pd.Series(np.ravel(pairwise_distances(wp_data.loc[dm_boundaries, :],
-                                                             wp_data.loc[i, :].values.reshape(1, -1))),
-                                 index=dm_boundaries).idxmin()
-                       for i in cells]
+    cell_idx = waypoints.get_indexer(cells)
+    n_comps, labels = csgraph.connected_components(
+        T[cell_idx, :][:, cell_idx], directed=False)
+    cells = [pseudotime[cells[labels == i]].idxmax() for i in range(n_comps)]
+
+    # Nearest diffusion map boundaries in one distance computation
+    terminal_states = list(dm_boundaries[pairwise_distances_argmin(
+        wp_data.values[waypoints.get_indexer(cells), :],
+        wp_data.values[waypoints.get_indexer(dm_boundaries), :])])
     # excluded_boundaries = dm_boundaries.difference(terminal_states)
     return terminal_states
 
@@ -368,9 +450,12 @@ def _differentiation_entropy(wp_data, terminal_states,
     waypoints = wp_data.index
     abs_states = np.where(waypoints.isin(terminal_states))[0]
     # Reset absorption state affinities by Removing neigbors
+    # LIL supports the row-wise sparsity edits efficiently
+    T = T.tolil()
     T[abs_states, :] = 0
     # Diagnoals as 1s
     T[abs_states, abs_states] = 1
+    T = T.tocsr()
 
     # Fundamental matrix and absorption probabilities
     print('Computing fundamental matrix and absorption probabilities...')
@@ -378,20 +463,21 @@ def _differentiation_entropy(wp_data, terminal_states,
     trans_states = list(set(range(len(waypoints))).difference(abs_states))
 
     # Q matrix
-    Q = T[trans_states, :][:, trans_states]
-    # Fundamental matrix
-    mat = np.eye(Q.shape[0]) - Q.todense()
-    N = inv(mat)
-
-    # Absorption probabilities
-    branch_probs = np.dot(N, T[trans_states, :][:, abs_states].todense())
+    Q = T[trans_states, :][:, trans_states].tocsc()
+
+    # Absorption probabilities by solving (I - Q) X = R, avoiding the
+    # dense fundamental matrix
+    R = T[trans_states, :][:, abs_states].toarray()
+    branch_probs = spsolve(eye(Q.shape[0], format='csc') - Q, R)
+    if len(abs_states) == 1:
+        branch_probs = branch_probs.reshape(-1, 1)
     branch_probs = pd.DataFrame(branch_probs,
                                 index=waypoints[trans_states],
                                 columns=waypoints[abs_states])
     branch_probs[branch_probs < 0] = 0
 
     # Entropy
-    ent = branch_probs.apply(entropy, axis=1)
+    ent = _branch_entropy(branch_probs)
 
     # Add terminal states
     ent = ent.append(pd.Series(0, index=terminal_states))
@@ -402,8 +488,18 @@ def _differentiation_entropy(wp_data, terminal_states,
     return ent, branch_probs
 
 
-def _shortest_path_helper(cell, adj):
-    return pd.Series(csgraph.dijkstra(adj, False, cell))
+def _branch_entropy(branch_probs):
+    """Row-wise entropy of branch probabilities
+
+    :param branch_probs: Branch probabilities [Cells X Branches]
+    :return: pandas Series of entropies
+    """
+    probs = branch_probs.values
+    probs = probs / probs.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        plogp = probs * np.log(probs)
+    ent = -np.where(np.isfinite(plogp), plogp, 0).sum(axis=1)
+    return pd.Series(ent, index=branch_probs.index)
 
 
 def _connect_graph(adj, data, start_cell):
@@ -419,27 +515,33 @@ def _connect_graph(adj, data, start_cell):
         print('Warning: Some of the cells were unreachable. Consider increasing the k for \n \
             nearest neighbor graph construction.')
 
-    # Connect unreachable nodes
-    while len(unreachable_nodes) > 0:
-        farthest_reachable = np.where(data.index == dists.idxmax())[0][0]
+        # Edit the adjacency matrix in LIL format, which supports
+        # efficient sparsity changes
+        adj = adj.tolil()
+
+        # Connect unreachable nodes
+        while len(unreachable_nodes) > 0:
+            farthest_reachable = data.index.get_loc(dists.idxmax())
+
+            # Compute distances to unreachable nodes
+            unreachable_dists = pairwise_distances(data.iloc[farthest_reachable, :].values.reshape(1, -1),
+                                                   data.loc[unreachable_nodes, :])
+            unreachable_dists = pd.Series(
+                np.ravel(unreachable_dists), index=unreachable_nodes)
 
-        # Compute distances to unreachable nodes
-        unreachable_dists = pairwise_distances(data.iloc[farthest_reachable, :].values.reshape(1, -1),
-                                               data.loc[unreachable_nodes, :])
-        unreachable_dists = pd.Series(
-            np.ravel(unreachable_dists), index=unreachable_nodes)
+            # Add edge between farthest reacheable and its nearest unreachable
+            add_edge = data.index.get_loc(unreachable_dists.idxmin())
+            adj[farthest_reachable, add_edge] = unreachable_dists.min()
 
-        # Add edge between farthest reacheable and its nearest unreachable
-        add_edge = np.where(data.index == unreachable_dists.idxmin())[0][0]
-        adj[farthest_reachable, add_edge] = unreachable_dists.min()
+            # Recompute distances to early cell
+            graph = nx.Graph(adj)
+            dists = pd.Series(
+                nx.single_source_dijkstra_path_length(graph, start_cell))
+            dists = pd.Series(dists.values, index=data.index[dists.index])
 
-        # Recompute distances to early cell
-        graph = nx.Graph(adj)
-        dists = pd.Series(
-            nx.single_source_dijkstra_path_length(graph, start_cell))
-        dists = pd.Series(dists.values, index=data.index[dists.index])
+            # Idenfity unreachable nodes
+            unreachable_nodes = data.index.difference(dists.index)
 
-        # Idenfity unreachable nodes
-        unreachable_nodes = data.index.difference(dists.index)
+        adj = adj.tocsr()
 
     return adj